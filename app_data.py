@@ -1,15 +1,22 @@
 import sqlite3
 import datetime
 import os
+import copy
+import contextlib
 
 import pandas as pd
 import numpy as np
 
 from CONSTANTS import CONST
 import global_vars as global_vars
+from single_flight import SingleFlight
 
-con = sqlite3.connect('../../databases/data', check_same_thread=False,
-                      timeout=10)
+DB_PATH = '../../databases/data'
+con = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
+# All requests to con go through con_lock. It doesn't lock anything, so
+# behaviour is the same as without it; load_test.py replaces it with a timed
+# lock to measure the cost of serializing the shared connection
+con_lock = contextlib.nullcontext()
 
 
 class DataTables:
@@ -135,6 +142,23 @@ class SupplyTime(DataTables):
         If 1 -> millions of m3, if 1000 -> billions of m3
     """
 
+    # Repeated text columns, which are converted to category in compact mode
+    _CATEGORY_COLUMNS = ['country_from', 'country_to', 'point', 'point_type',
+                         'period']
+    # (PRAGMA data_version of con, {series: bool}) - results of
+    # __eu_aggregates_ready, valid until database is changed
+    _eu_aggregates_checked = (None, {})
+    # Types of dates, which are taken from materialized EU series. 'Год' is
+    # not: frames of tables are split by first date of every table in the
+    # first year, which can't be reproduced from sums of all tables
+    _EU_AGGREGATES_DATE_TYPES = ('День', 'Неделя', 'Месяц')
+    # Name of the line, which sums points (countries) out of top_n
+    OTHER_LABEL = 'Прочие'
+    # Max number of tables in one 'union all' request (sqlite limit is 500)
+    _UNION_BATCH = 400
+    # Max number of frames with rolling statistics kept by one instance
+    _ROLLING_CACHE_SIZE = 4
+
     def get_data(self) -> pd.DataFrame:
         """
         Method returns generated data
@@ -142,6 +166,135 @@ class SupplyTime(DataTables):
         """
         return self._data
 
+    def get_rolling_data(self, window: int,
+                         stats=('mean', 'min', 'max', 'cum')) -> pd.DataFrame:
+        """
+        Method returns data with rolling statistics of volume for every line
+        (point, country or sum depending on groupby): columns
+        volume_ma<window>, volume_min<window>, volume_max<window> and
+        volume_cum (cumulative volume from start_date). Statistics are
+        computed on data with rolling_lookback periods before start_date,
+        so there are no edge effects if window <= rolling_lookback (rows
+        without full window are NaN). Results are cached by window and
+        stats (last _ROLLING_CACHE_SIZE of them) and the same frame is
+        returned to every caller, so it should be treated as read-only (like
+        get_data). Data is downsampled if max_points is set.
+            :param window: int, number of periods of date_type in window
+            :param stats: tuple of str, any of 'mean', 'min', 'max', 'cum'
+            :return: pd.DataFrame
+        """
+        key = (window, tuple(stats))
+        if key in self._rolling_cache:
+            return self._rolling_cache[key]
+
+        if self._base_data.empty:
+            return self._base_data
+        series_columns = self.__get_series_columns(self._base_data)
+        periods = pd.to_datetime(self._base_data['period_from'])
+        dataframe = self._base_data.assign(_period=periods).sort_values(
+            series_columns + ['_period'], kind='stable').reset_index(
+            drop=True)
+        volume = dataframe['volume'].astype(np.float64)
+        keys = [dataframe[item] for item in series_columns]
+
+        if keys:
+            rolling = volume.groupby(keys, observed=True, sort=False).rolling(
+                window, min_periods=window)
+        else:
+            rolling = volume.rolling(window, min_periods=window)
+        for stat, column in (('mean', f'volume_ma{window}'),
+                             ('min', f'volume_min{window}'),
+                             ('max', f'volume_max{window}')):
+            if stat in stats:
+                values = getattr(rolling, stat)()
+                if keys:
+                    values = values.droplevel(list(range(len(keys))))
+                dataframe[column] = values
+
+        dataframe = dataframe[self.__is_shown_period(dataframe['_period'])]
+        if 'cum' in stats:
+            volume = volume[dataframe.index]
+            if keys:
+                dataframe['volume_cum'] = volume.groupby(
+                    [item[dataframe.index] for item in keys],
+                    observed=True, sort=False).cumsum()
+            else:
+                dataframe['volume_cum'] = volume.cumsum()
+        dataframe = dataframe.drop(columns='_period')
+
+        if self._max_points is not None and not dataframe.empty:
+            dataframe = self.__downsample(dataframe, self._max_points)
+        dataframe = dataframe.reset_index(drop=True)
+        if len(self._rolling_cache) >= self._ROLLING_CACHE_SIZE:
+            # the oldest frame is dropped
+            self._rolling_cache.pop(next(iter(self._rolling_cache)), None)
+        self._rolling_cache[key] = dataframe
+        return dataframe
+
+    def get_global_data(self) -> pd.DataFrame:
+        """
+        Method returns data, which is (or would be) set to
+        global_vars.CURRENT_GRAPH_DATA by this instance, or None if
+        instance doesn't set global data (e.g. empty frame by country)
+            :return: pd.DataFrame or None
+        """
+        return self._global_data
+
+    def publish_global_data(self) -> None:
+        """
+        Method sets copy of global data of this instance to
+        global_vars.CURRENT_GRAPH_DATA (used when instance is shared by
+        several requests, see get_supply_time)
+        """
+        if self._global_data is not None:
+            global_vars.CURRENT_GRAPH_DATA = self._global_data.copy()
+
+    def copy(self) -> 'SupplyTime':
+        """
+        Method returns copy of instance with own copies of data frames, so
+        caller can change them without affecting other callers
+            :return: SupplyTime
+        """
+        supply_time = copy.copy(self)
+        supply_time._data = self._data.copy()
+        if self._base_data is self._data:
+            supply_time._base_data = supply_time._data
+        else:
+            supply_time._base_data = self._base_data.copy()
+        supply_time._rolling_cache = {}
+        return supply_time
+
+    def get_empty_frame(self) -> pd.DataFrame:
+        """
+        Method returns frame without rows, but with the same columns and
+        dtypes as not empty data of this instance has (empty data is often
+        pd.DataFrame({}) without columns)
+            :return: pd.DataFrame
+        """
+        if self._flow_type == 'net_flow':
+            columns = ['country']
+        elif self.groupby == 'point':
+            columns = ['country_from', 'country_to', 'point']
+        elif self.groupby == 'country':
+            columns = [self.get_exp_or_imp_groupby()]
+        else:
+            columns = []
+        columns += ['period_from', 'period', 'volume', 'gas_KWh']
+        dataframe = pd.DataFrame({
+            item: pd.Series(dtype='float64' if item in ('volume', 'gas_KWh')
+                            else 'object') for item in columns})
+        if self._compact:
+            dataframe = self.__compact_frame(dataframe)
+        return dataframe
+
+    def get_downsample_info(self) -> dict:
+        """
+        Method returns number of rows before and after downsampling (equal
+        if max_points is not set)
+            :return: dict with keys 'original_rows', 'reduced_rows'
+        """
+        return self._downsample_info
+
     def get_exp_or_imp_groupby(self) -> str:
         """
         If instance has attribute __exp_or_imp_groupby returns it, otherwise
@@ -156,7 +309,10 @@ class SupplyTime(DataTables):
     def __init__(self, start_date: pd.Timestamp, end_date: pd.Timestamp,
                  measure: str, date_type: str, groupby: str, flow_type: str,
                  exporter_to_eu: str, exporter: str,
-                 importer: str, selected_points: list):
+                 importer: str, selected_points: list,
+                 set_global_data: bool = True, compact: bool = False,
+                 top_n: int = None, max_points: int = None,
+                 rolling_lookback: int = None):
         """
         Object initialization
             :param start_date: pd.Timestamp, period_from filter
@@ -177,6 +333,21 @@ class SupplyTime(DataTables):
             :param exporter: str, rus name of country-exporter
             :param importer: rus name of country-importer
             :param selected_points: list of str, english names of points
+            :param set_global_data: bool, if False generated data is not
+                copied to global_vars.CURRENT_GRAPH_DATA (e.g. for exports)
+            :param compact: bool, if True frames use compact dtypes (see
+                __compact_frame)
+            :param top_n: int, if set and groupby is 'point' or 'country',
+                only top_n points (countries) with the biggest volume over
+                the period get their own lines, others are summed into one
+                line OTHER_LABEL
+            :param max_points: int, if set every line (point, country or
+                sum) is downsampled to about max_points rows (see
+                __downsample), global data stays full
+            :param rolling_lookback: int, number of periods of date_type
+                fetched before start_date for rolling statistics (see
+                get_rolling_data), should be not less than the longest window.
+                For 'Год' the year of start_date is summed from January 1
         """
 
         # Case when user choose 'ЕС' with groupby != sum graph will be very
@@ -188,11 +359,21 @@ class SupplyTime(DataTables):
         self._set_start_date(start_date)
         self._set_end_date(end_date)
         self.__set_flow_type(flow_type)
+        self._set_global_data = set_global_data
+        self._global_data = None
+        self._compact = compact
+        self._top_n = top_n
+        requested_start_date = self._start_date
+        if rolling_lookback:
+            self._start_date = requested_start_date - \
+                self.__get_lookback_offset(rolling_lookback)
 
         data = pd.DataFrame({})
         if exporter_to_eu is not None:
+            eu_series = None
             if exporter_to_eu in CONST.GROUP_EXPORT:
                 suitable_tables = CONST.GROUP_EXPORT[exporter_to_eu].copy()
+                eu_series = ('group:' + exporter_to_eu, '')
             else:
                 code = CONST.COUNTRY_CODE_DICT[exporter_to_eu]
                 suitable_tables = self.__select_tables_exp_to_eu(code)
@@ -211,7 +392,8 @@ class SupplyTime(DataTables):
                                                 end_date=self._end_date,
                                                 divider=self.divider,
                                                 date_type=self.date_type,
-                                                exp_or_imp_groupby=self.__exp_or_imp_groupby
+                                                exp_or_imp_groupby=self.__exp_or_imp_groupby,
+                                                eu_series=eu_series
                                                 )
 
             elif self.groupby == 'sum':
@@ -219,7 +401,8 @@ class SupplyTime(DataTables):
                                             start_date=self._start_date,
                                             end_date=self._end_date,
                                             divider=self.divider,
-                                            date_type=self.date_type)
+                                            date_type=self.date_type,
+                                            eu_series=eu_series)
 
         else:
             # Case gross flows, not net flows
@@ -233,12 +416,18 @@ class SupplyTime(DataTables):
                             tables_list=suitable_tables,
                             start_date=self._start_date,
                             end_date=self._end_date, divider=self.divider,
-                            date_type=self.date_type)
+                            date_type=self.date_type, with_direction=True)
                         # Special point name for points
                         if not data.empty:
-                            data['point'] = data['country_from'] + '\u279C' + \
-                                data['country_to'] + ' (' + data[
-                                'point'] + ')'
+                            data['point'] = (
+                                data['country_from'].astype(str) +
+                                '\u279C' + data['country_to'].astype(str) +
+                                ' (' + data['point'].astype(str) + ')'
+                            ).where(data['point'] != self.OTHER_LABEL,
+                                    self.OTHER_LABEL)
+                            if self._compact:
+                                data['point'] = data['point'].astype(
+                                    'category')
                     elif self.groupby == 'country':
                         self.__exp_or_imp_groupby = 'country_from'
                         data = self.__gen_df_by_country(tables_list=suitable_tables,
@@ -273,7 +462,10 @@ class SupplyTime(DataTables):
                                          end_date=self._end_date,
                                          divider=self.divider,
                                          date_type=self.date_type,
-                                         exp_or_imp_groupby=self.__exp_or_imp_groupby)
+                                         exp_or_imp_groupby=self.__exp_or_imp_groupby,
+                                         eu_series=self.__select_eu_series(
+                                             exp_name=exporter,
+                                             imp_name=importer))
 
             # Case net flows
             elif flow_type == 'net_flow':
@@ -291,7 +483,10 @@ class SupplyTime(DataTables):
                                             end_date=self._end_date,
                                             divider=self.divider,
                                             date_type=self.date_type,
-                                            exp_or_imp_groupby=self.__exp_or_imp_groupby)
+                                            exp_or_imp_groupby=self.__exp_or_imp_groupby,
+                                            eu_series=self.__select_eu_series(
+                                                exp_name=exporter,
+                                                imp_name=None))
                 self.__exp_or_imp_groupby = 'country_to'
                 suitable_tables_imp = self.__select_tables_by_country(
                     exp_name=None, imp_name=exporter)
@@ -301,7 +496,10 @@ class SupplyTime(DataTables):
                                             end_date=self._end_date,
                                             divider=self.divider,
                                             date_type=self.date_type,
-                                            exp_or_imp_groupby=self.__exp_or_imp_groupby)
+                                            exp_or_imp_groupby=self.__exp_or_imp_groupby,
+                                            eu_series=self.__select_eu_series(
+                                                exp_name=None,
+                                                imp_name=exporter))
 
                 data = \
                     self.__subtract_frames(df1=import_data, df2=export_data)
@@ -310,6 +508,8 @@ class SupplyTime(DataTables):
                 # but in case net_flows full dataframe is ready only here,
                 # not in func, so need to set global_data here
                 data['country'] = exporter
+                if self._compact:
+                    data['country'] = data['country'].astype('category')
                 data = data[['country'] + [item for item in data.columns if
                                            item != 'country']]
                 self.__set_global_data(data)
@@ -318,12 +518,123 @@ class SupplyTime(DataTables):
         # available only for these tabs
         if date_type == 'Неделя':
             if not data.empty:
-                data['period'] = data['period'] + ' (' + data[
-                    'period_from'].str.slice(8, 10) + '/' + data[
-                    'period_from'].str.slice(5, 7) + ')'
+                if self._compact:
+                    data['period'] = (data['period'].astype(str) + ' (' +
+                                      data['period_from'].dt.strftime(
+                                          '%d/%m') + ')').astype('category')
+                else:
+                    data['period'] = data['period'] + ' (' + data[
+                        'period_from'].str.slice(8, 10) + '/' + data[
+                        'period_from'].str.slice(5, 7) + ')'
+
+        # data with history before start_date is kept for rolling statistics,
+        # data on the graph starts from start_date
+        self._start_date = requested_start_date
+        self._base_data = data
+        self._rolling_cache = {}
+        if rolling_lookback and not data.empty:
+            data = data[self.__is_shown_period(
+                pd.to_datetime(data['period_from']))]
+            self.__set_global_data(data)
+
+        self._max_points = max_points
+        self._downsample_info = {'original_rows': len(data),
+                                 'reduced_rows': len(data)}
+        if max_points is not None and not data.empty:
+            data = self.__downsample(data, max_points)
+            self._downsample_info['reduced_rows'] = len(data)
 
         self._data = data
 
+    def __is_shown_period(self, periods: pd.Series) -> pd.Series:
+        """
+        Checks which periods of data fetched with rolling_lookback are shown
+        on the graph: days, weeks and months starting from start_date (not
+        full weeks and months are thrown out without lookback) and years
+        starting from the year of start_date (period_from of this year is
+        January 1 with lookback)
+            :param periods: pd.Series of pd.Timestamp, period_from
+            :return: pd.Series of bool
+        """
+        start_date = pd.Timestamp(self._start_date).normalize()
+        if self.date_type == 'Год':
+            return periods.dt.year >= start_date.year
+        return periods >= start_date
+
+    def __get_lookback_offset(self, periods: int) -> pd.DateOffset:
+        """
+        Returns offset of periods of date_type
+            :param periods: int
+            :return: pd.DateOffset
+        """
+        if self.date_type == 'Неделя':
+            return pd.DateOffset(weeks=periods)
+        elif self.date_type == 'Месяц':
+            return pd.DateOffset(months=periods)
+        elif self.date_type == 'Год':
+            return pd.DateOffset(years=periods)
+        return pd.DateOffset(days=periods)
+
+    def __get_series_columns(self, data: pd.DataFrame) -> list:
+        """
+        Returns columns which define lines of the graph depending on groupby
+        (empty list if data is one line)
+            :param data: pd.DataFrame
+            :return: list of str
+        """
+        if self.groupby == 'point':
+            series_columns = ['point']
+        elif self.groupby == 'country':
+            series_columns = [self.get_exp_or_imp_groupby()]
+        else:
+            series_columns = []
+        return [item for item in series_columns if item in data.columns]
+
+    def __downsample(self, data: pd.DataFrame,
+                     max_points: int) -> pd.DataFrame:
+        """
+        Reduces every line of data (point, country or sum depending on
+        groupby) with more than max_points rows by min/max bucketing: rows
+        of line are divided into max_points // 2 buckets by period_from and
+        rows with min and max volume of every bucket are kept together with
+        the first and the last rows of line, so peaks stay on the graph.
+        All lines are processed at once by numpy.
+            :param data: pd.DataFrame with period_from and volume columns
+            :param max_points: int, target number of rows of one line
+            :return: pd.DataFrame, rows of data in the same order
+        """
+        series_columns = self.__get_series_columns(data)
+        if series_columns:
+            codes = data.groupby(series_columns, sort=False,
+                                 observed=True).ngroup().to_numpy()
+        else:
+            codes = np.zeros(len(data), dtype=np.int64)
+        periods = pd.to_datetime(data['period_from']).to_numpy()
+
+        # rows sorted by line and period_from
+        order = np.lexsort((periods, codes))
+        codes = codes[order]
+        volumes = data['volume'].to_numpy(dtype=np.float64)[order]
+        counts = np.bincount(codes)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sizes = counts[codes]
+        positions = np.arange(len(codes)) - starts[codes]
+
+        n_buckets = max(max_points // 2, 1)
+        buckets = codes * n_buckets + positions * n_buckets // sizes
+
+        keep = sizes <= max_points
+        keep[starts] = True
+        keep[starts + counts - 1] = True
+        for values in (volumes, -volumes):
+            by_bucket = np.lexsort((values, buckets))
+            sorted_buckets = buckets[by_bucket]
+            first = np.concatenate(
+                ([True], sorted_buckets[1:] != sorted_buckets[:-1]))
+            keep[by_bucket[first]] = True
+
+        return data.iloc[np.sort(order[keep])]
+
     def __set_flow_type(self, flow_type: str) -> None:
         """
         Method sets _flow_type parameter to instance of the class
@@ -334,14 +645,105 @@ class SupplyTime(DataTables):
         else:
             self._flow_type = 'gross_flow'
 
-    @staticmethod
-    def __set_global_data(dataframe: pd.DataFrame) -> None:
+    def __set_global_data(self, dataframe: pd.DataFrame) -> None:
         """
-        Sets current generated data to global variable (located in
-        dash_app/global_vars.py)
+        Saves copy of current generated data (see get_global_data) and sets
+        it to global variable (located in dash_app/global_vars.py) if it is
+        not disabled by set_global_data init param
             :param dataframe: current data
         """
-        global_vars.CURRENT_GRAPH_DATA = dataframe.copy()
+        self._global_data = dataframe.copy()
+        if self._set_global_data:
+            global_vars.CURRENT_GRAPH_DATA = self._global_data
+
+    @staticmethod
+    def _split_period(start_date: pd.Timestamp, end_date: pd.Timestamp,
+                      date_type: str, chunk_months=1) -> list:
+        """
+        Splits [start_date, end_date] into consecutive chunks which don't
+        break periods of date_type: chunk_months months for 'День' and
+        'Месяц', years for 'Неделя' and 'Год' (weeks are grouped by '%Y-%W'
+        in sql, so they never cross the border of a year)
+            :param start_date: pd.Timestamp
+            :param end_date: pd.Timestamp
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год'
+            :param chunk_months: int, length of chunk in months for 'День'
+                and 'Месяц'
+            :return: list of tuples (chunk_start, chunk_end)
+        """
+        start_date = pd.Timestamp(start_date)
+        end_date = pd.Timestamp(end_date)
+        freq = f'{chunk_months}MS' if date_type in ('День', 'Месяц') \
+            else 'YS'
+        bounds = [item for item in pd.date_range(start_date.normalize(),
+                                                 end_date, freq=freq)
+                  if item > start_date.normalize()]
+        starts = [start_date] + bounds
+        ends = [item - pd.Timedelta(days=1) for item in bounds] + [end_date]
+        return list(zip(starts, ends))
+
+    @classmethod
+    def _iter_chunks(cls, start_date: pd.Timestamp, end_date: pd.Timestamp,
+                     date_type: str, chunk_months=1, **params):
+        """
+        Returns generator which yields SupplyTime for every chunk of the
+        period (see _split_period), global data is not changed. At least one
+        instance is yielded. top_n and max_points are not supported: they
+        would be applied to every chunk separately, so lines in 'Прочие' and
+        downsampling would change from chunk to chunk
+            :param start_date: pd.Timestamp, if None - the same default as
+                in DataTables
+            :param end_date: pd.Timestamp, if None - CONST.TODAY
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год'
+            :param chunk_months: int, length of chunk in months for 'День'
+                and 'Месяц'
+            :param params: other init params of SupplyTime
+            :return: generator of SupplyTime
+        """
+        for key in ('top_n', 'max_points'):
+            if params.get(key) is not None:
+                raise ValueError(f'{key} is not supported for data split '
+                                 f'into chunks')
+        if start_date is None:
+            start_date = datetime.datetime.now() - pd.DateOffset(
+                months=1) * CONST.MONTH_TO_SHOW
+        if end_date is None:
+            end_date = CONST.TODAY
+        params['set_global_data'] = False
+        return (cls(start_date=chunk_start, end_date=chunk_end,
+                    date_type=date_type, **params)
+                for chunk_start, chunk_end in cls._split_period(
+                    start_date, end_date, date_type,
+                    chunk_months=chunk_months))
+
+    @classmethod
+    def iter_frames(cls, start_date: pd.Timestamp, end_date: pd.Timestamp,
+                    date_type: str, chunk_months=1, **params):
+        """
+        Generator which yields data of SupplyTime chunk by chunk (see
+        _split_period). Every chunk is generated by SupplyTime itself, so
+        selection and aggregation logic is the same as on the graph, but
+        only one chunk is kept in memory. Global data is not changed.
+        Every chunk queries all tables again (filtered by period_from), so
+        bigger chunk_months means less requests but more memory.
+        !!! tables with all volumes equal to 0 are thrown out per chunk, not
+        per full period (see __gen_frame_from_sql); top_n and max_points are
+        not supported (see _iter_chunks)
+            :param start_date: pd.Timestamp, if None - the same default as
+                in DataTables
+            :param end_date: pd.Timestamp, if None - CONST.TODAY
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год'
+            :param chunk_months: int, length of chunk in months for 'День'
+                and 'Месяц'
+            :param params: other init params of SupplyTime
+            :return: generator of not empty pd.DataFrame
+        """
+        for supply_time in cls._iter_chunks(start_date, end_date, date_type,
+                                            chunk_months=chunk_months,
+                                            **params):
+            frame = supply_time.get_data()
+            if not frame.empty:
+                yield frame
 
     @staticmethod
     def __select_tables_exp_to_eu(exporter_to_eu_code: str) -> list:
@@ -459,6 +861,390 @@ class SupplyTime(DataTables):
 
         return suitable_tables
 
+    @staticmethod
+    def __select_eu_series(exp_name: str, imp_name: str):
+        """
+        Chooses materialized EU series (see refresh_eu_aggregates) with the
+        same tables as __select_tables_by_country(exp_name, imp_name) has.
+        Returns None when one of parameters is not 'ЕС' or result is empty
+        anyway (both are 'ЕС' or counterpart is an EU country)
+            :param exp_name: str, rus name of country-exporter
+            :param imp_name: str, rus name of country-importer
+            :return: tuple (series, sql condition on eu_agg_series) or None
+        """
+        if exp_name == imp_name == 'ЕС':
+            return None
+        elif exp_name == 'ЕС':
+            if imp_name is None:
+                return 'eu_export', ''
+            importer_code = CONST.COUNTRY_CODE_DICT[imp_name]
+            if importer_code in CONST.EU_CODES:
+                return None
+            return 'eu_export', f"and a.imp_code = '{importer_code}'"
+        elif imp_name == 'ЕС':
+            if exp_name is None:
+                return 'eu_import', ''
+            exporter_code = CONST.COUNTRY_CODE_DICT[exp_name]
+            if exporter_code in CONST.EU_CODES:
+                return None
+            return 'eu_import', f"and a.exp_code = '{exporter_code}'"
+        return None
+
+    @staticmethod
+    def __get_eu_series_tables() -> dict:
+        """
+        Returns tables of every materialized EU series: all EU outflows
+        ('eu_export'), all EU inflows ('eu_import') and groups of exporters
+        from CONST.GROUP_EXPORT ('group:<name>')
+            :return: dict, name of series -> list of names of tables
+        """
+        series_tables = {
+            'eu_export': SupplyTime.__select_tables_by_country(
+                exp_name='ЕС', imp_name=None),
+            'eu_import': SupplyTime.__select_tables_by_country(
+                exp_name=None, imp_name='ЕС'),
+        }
+        for name, tables in CONST.GROUP_EXPORT.items():
+            series_tables['group:' + name] = list(tables)
+        return series_tables
+
+    @staticmethod
+    def __get_last_dates(connection, tables: list) -> dict:
+        """
+        Returns max(period_from) of every table (requests are batched by
+        _UNION_BATCH tables)
+            :param connection: sqlite3.Connection
+            :param tables: list of str, names of tables
+            :return: dict, name of table -> str or None for empty table
+        """
+        last_dates = {}
+        for i in range(0, len(tables), SupplyTime._UNION_BATCH):
+            sql = '\n union all \n'.join(
+                f"select '{table_name}', (select max(period_from) "
+                f"from table_{table_name.replace('-', '_')})"
+                for table_name in tables[i:i + SupplyTime._UNION_BATCH])
+            last_dates.update(connection.execute(sql).fetchall())
+        return last_dates
+
+    @staticmethod
+    def refresh_eu_aggregates(overlap_days=7, connection=None) -> None:
+        """
+        Builds or incrementally refreshes materialized EU series: daily sums
+        of volume (millions of m3, not rounded) and gas_KWh by exporter,
+        importer and point type in table eu_agg_series and sums of full
+        weeks/months of every table (checked like in __gen_frame_from_sql)
+        in table eu_agg_periods. Last date of every table is saved in
+        eu_agg_state. Series is recomputed starting
+        overlap_days before the oldest saved date among tables, whose last
+        date has changed (so corrections of recent days are taken too),
+        series without changed tables are skipped. If set of tables of
+        series is changed, series is rebuilt.
+        Should be called after every update of database.
+            :param overlap_days: int, number of days recomputed before the
+                last saved date
+            :param connection: sqlite3.Connection, if None - new connection
+                to DB_PATH is used (con is not blocked while refreshing)
+        """
+        own_connection = connection is None
+        if own_connection:
+            connection = sqlite3.connect(DB_PATH, timeout=60)
+        try:
+            SupplyTime.__refresh_eu_aggregates(connection, overlap_days)
+        finally:
+            if own_connection:
+                connection.close()
+        SupplyTime._eu_aggregates_checked = (None, {})
+
+    @staticmethod
+    def __get_period_bounds_sql(date_type: str) -> tuple:
+        """
+        Returns sql expressions of the first and the last day of full week
+        ('%W', starts on monday) or month, which contains p.period_from
+            :param date_type: str, one of 'Неделя', 'Месяц'
+            :return: tuple of str, sql
+        """
+        if date_type == 'Неделя':
+            start_sql = "date(p.period_from, '-6 days', 'weekday 1')"
+            return start_sql, f"date({start_sql}, '+6 days')"
+        return ("date(p.period_from, 'start of month')",
+                "date(p.period_from, 'start of month', '+1 month', "
+                "'-1 day')")
+
+    @staticmethod
+    def __refresh_eu_aggregates(connection, overlap_days: int) -> None:
+        """
+        Body of refresh_eu_aggregates, runs in one transaction of connection
+        """
+        series_tables = SupplyTime.__get_eu_series_tables()
+        last_dates = SupplyTime.__get_last_dates(
+            connection, sorted({item for tables in series_tables.values()
+                                for item in tables}))
+        with connection:
+            connection.execute('''
+                create table if not exists eu_agg_series (
+                    series text, exp_code text, imp_code text,
+                    country_from text, country_to text, point_type text,
+                    period_from text, volume real, gas_KWh real
+                )
+            ''')
+            connection.execute('''
+                create index if not exists eu_agg_series_idx
+                on eu_agg_series (series, period_from)
+            ''')
+            periods_exist = connection.execute(
+                "select count(*) from sqlite_master "
+                "where type = 'table' and name = 'eu_agg_periods'"
+            ).fetchone()[0]
+            connection.execute('''
+                create table if not exists eu_agg_periods (
+                    series text, date_type text, exp_code text,
+                    imp_code text, country_from text, country_to text,
+                    point_type text, period_start text, period_end text,
+                    period_from text, period text, volume real, gas_KWh real
+                )
+            ''')
+            connection.execute('''
+                create index if not exists eu_agg_periods_idx
+                on eu_agg_periods (series, date_type, period_start)
+            ''')
+            connection.execute('''
+                create table if not exists eu_agg_state (
+                    series text, table_name text, last_period_from text,
+                    primary key (series, table_name)
+                )
+            ''')
+            if not periods_exist:
+                # Series built before eu_agg_periods are rebuilt
+                connection.execute('delete from eu_agg_state')
+
+            for series, tables in series_tables.items():
+                state = dict(connection.execute(
+                    'select table_name, last_period_from from eu_agg_state '
+                    'where series = ?', (series,)).fetchall())
+                changed = [item for item in tables
+                           if item not in state or
+                           state[item] != last_dates[item]]
+                if set(state) == set(tables) and not changed:
+                    continue
+                saved_dates = [state[item] for item in changed
+                               if state.get(item) is not None]
+                if set(state) != set(tables) or \
+                        len(saved_dates) < len(changed):
+                    refresh_from = periods_from = '0000-00-00'
+                else:
+                    refresh_from = (pd.Timestamp(min(saved_dates)) -
+                                    pd.Timedelta(days=overlap_days))
+                    # Weeks and months are recomputed from their first day
+                    periods_from = (refresh_from - pd.Timedelta(days=7)
+                                    ).replace(day=1).date()
+                    refresh_from = refresh_from.date()
+
+                connection.execute(
+                    "delete from eu_agg_series where series = ? "
+                    "and strftime('%Y-%m-%d', period_from) >= ?",
+                    (series, str(refresh_from)))
+                connection.execute(
+                    'delete from eu_agg_periods where series = ? '
+                    'and period_start >= ?', (series, str(periods_from)))
+                connection.execute('delete from eu_agg_state '
+                                   'where series = ?', (series,))
+                connection.execute('drop table if exists temp.eu_agg_stage')
+                connection.execute('''
+                    create temp table eu_agg_stage (
+                        exp_code text, imp_code text, country_from text,
+                        country_to text, point_type text, period_from text,
+                        volume real, gas_KWh real
+                    )
+                ''')
+
+                for table_name in tables:
+                    country_from, country_to, point_type_name = \
+                        SupplyTime.__get_table_defaults(table_name)
+                    sql_name = f"table_{table_name.replace('-', '_')}"
+                    connection.execute(f'''
+                        insert into eu_agg_stage
+                        select
+                            '{table_name[:2]}', '{table_name[3:5]}',
+                            coalesce(m.country_from, '{country_from}'),
+                            coalesce(m.country_to, '{country_to}'),
+                            coalesce(m.point_type, '{point_type_name}'),
+                            m.period_from,
+                            case when m.gcv_value is not Null and m.gcv_value > 0
+                                then m.gas_KWh/m.gcv_value/1000000
+                                else m.gas_KWh/11.4/1000000 end,
+                            m.gas_KWh
+                        from {sql_name} as m
+                        where strftime('%Y-%m-%d', m.period_from) >= '{refresh_from}'
+                    ''')
+                    for date_type in ('Неделя', 'Месяц'):
+                        start_sql, end_sql = \
+                            SupplyTime.__get_period_bounds_sql(date_type)
+                        connection.execute(f'''
+                            insert into eu_agg_periods
+                            select
+                                ?, ?, '{table_name[:2]}', '{table_name[3:5]}',
+                                p.country_from, p.country_to, p.point,
+                                {start_sql}, {end_sql}, p.period_from,
+                                p.period, p.volume, p.gas_KWh
+                            from (
+                                with main as (
+                                    select
+                                        coalesce(m.country_from, '{country_from}') as country_from,
+                                        coalesce(m.country_to, '{country_to}') as country_to,
+                                        coalesce(m.point_type, '{point_type_name}') as point,
+                                        m.period_from,
+                                        case when m.gcv_value is not Null and m.gcv_value > 0
+                                            then m.gas_KWh/m.gcv_value/1000000
+                                            else m.gas_KWh/11.4/1000000 end
+                                        as volume,
+                                        m.gas_KWh
+                                    from {sql_name} as m
+                                    where strftime('%Y-%m-%d', m.period_from) >= '{periods_from}'
+                                    order by strftime('%Y-%m-%d', m.period_from)
+                                )
+                                {SupplyTime.__gen_period_sql(date_type)}
+                            ) as p
+                        ''', (series, date_type))
+                    connection.execute(
+                        'insert into eu_agg_state values (?, ?, ?)',
+                        (series, table_name, last_dates[table_name]))
+
+                connection.execute('''
+                    insert into eu_agg_series
+                    select
+                        ?, exp_code, imp_code, country_from, country_to,
+                        point_type, min(period_from), sum(volume), sum(gas_KWh)
+                    from eu_agg_stage
+                    group by exp_code, imp_code, country_from, country_to,
+                        point_type, strftime('%Y-%m-%d', period_from)
+                ''', (series,))
+                connection.execute('drop table temp.eu_agg_stage')
+
+    @staticmethod
+    def __eu_aggregates_ready(series: str) -> bool:
+        """
+        Checks if materialized EU series is up to date: eu_agg_state has the
+        same tables as the series and their saved last dates are equal to
+        current max(period_from) of tables. Result is cached until database
+        is changed (PRAGMA data_version of con)
+            :param series: str, name of series (see __get_eu_series_tables)
+            :return: bool
+        """
+        with con_lock:
+            version = con.execute('pragma data_version').fetchone()[0]
+        checked_version, checked = SupplyTime._eu_aggregates_checked
+        if checked_version != version:
+            checked = {}
+            SupplyTime._eu_aggregates_checked = (version, checked)
+        if series not in checked:
+            tables = SupplyTime.__get_eu_series_tables().get(series)
+            is_ready = False
+            if tables:
+                try:
+                    with con_lock:
+                        state = dict(con.execute(
+                            'select table_name, last_period_from '
+                            'from eu_agg_state where series = ?',
+                            (series,)).fetchall())
+                        is_ready = state == SupplyTime.__get_last_dates(
+                            con, tables)
+                        con.execute('select 1 from eu_agg_periods limit 1')
+                except sqlite3.OperationalError:
+                    # eu_agg_state, eu_agg_periods or one of tables doesn't
+                    # exist
+                    is_ready = False
+            checked[series] = is_ready
+        return checked[series]
+
+    def __gen_frame_from_eu_aggregates(self, eu_series: tuple,
+                                       start_date: pd.Timestamp,
+                                       end_date: pd.Timestamp, divider=1,
+                                       date_type='День',
+                                       group_column=None) -> pd.DataFrame:
+        """
+        Generates frame in the same format as __gen_frame_from_sql from
+        materialized EU series, summed by group_column or fully. Weeks and
+        months are taken from eu_agg_periods (checked for every table like
+        in __gen_frame_from_sql) if they lie inside [start_date, end_date].
+        Difference with summing frames of tables: volume is rounded after
+        summing.
+        !!! groups with all volume values equal to 0 are thrown out
+            :param eu_series: tuple (series, condition) from
+                __select_eu_series
+            :param start_date: pd.Timestamp (period_from filter)
+            :param end_date: pd.Timestamp (period_from filter)
+            :param divider: int, 1 or 1000,characteristic of measurement:
+                if 1 then in millions of m3, if 1000 then in billions of m3
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
+                different types of grouping data by period_from
+            :param group_column: str, one of 'country_from', 'country_to' or
+                None to sum all supplies
+            :return: pd.DataFrame
+        """
+        series, condition = eu_series
+        series = series.replace("'", "''")
+        if group_column is None:
+            columns = "'' as country_from, '' as country_to"
+            group_prefix = ''
+            period_group = ()
+        else:
+            columns = ', '.join(
+                f'a.{item}' if item == group_column else f"'' as {item}"
+                for item in ('country_from', 'country_to'))
+            group_prefix = f'a.{group_column}, '
+            period_group = (group_column,)
+
+        if date_type in ('Неделя', 'Месяц'):
+            sql = f'''
+                select
+                    {columns},
+                    '' as point,
+                    min(a.period_from) as period_from,
+                    a.period,
+                    round(sum(a.volume)/{divider}, 2) as volume,
+                    sum(a.gas_KWh) as gas_KWh
+
+                from eu_agg_periods as a
+                where a.series = '{series}' {condition}
+                    and a.date_type = '{date_type}'
+                    and a.period_start >= '{start_date.date()}'
+                    and a.period_end <= '{end_date.date()}'
+                group by {group_prefix}a.period_start
+                order by a.period_start
+            '''
+        else:
+            sql = f'''
+                with main as (
+                    select
+                        {columns},
+                        '' as point,
+                        min(a.period_from) as period_from,
+                        round(sum(a.volume)/{divider}, 2) as volume,
+                        sum(a.gas_KWh) as gas_KWh
+
+                    from eu_agg_series as a
+                    where a.series = '{series}' {condition}
+                        and strftime('%Y-%m-%d', a.period_from) >= '{start_date.date()}'
+                        and strftime('%Y-%m-%d', a.period_from) <= '{end_date.date()}'
+                    group by {group_prefix}strftime('%Y-%m-%d', a.period_from)
+                    order by strftime('%Y-%m-%d', a.period_from)
+                )
+            ''' + SupplyTime.__gen_period_sql(date_type, period_group)
+
+        with con_lock:
+            sql_frame = pd.read_sql(sql, con)
+
+        if group_column is None:
+            if not (sql_frame['volume'] != 0).any():
+                sql_frame = sql_frame.iloc[0:0]
+        else:
+            totals = sql_frame['volume'].abs().groupby(
+                sql_frame[group_column]).transform('sum')
+            sql_frame = sql_frame[totals > 0]
+        if self._compact and not sql_frame.empty:
+            sql_frame = self.__compact_frame(sql_frame.copy())
+        return sql_frame
+
     @staticmethod
     def __select_tables_by_point(point_names: list) -> list:
         """
@@ -501,9 +1287,9 @@ class SupplyTime(DataTables):
             df2['volume'] = df2['volume'] * (-1)
             df2['gas_KWh'] = df2['gas_KWh'] * (-1)
 
-        dataframe = pd.concat([df1, df2])
+        dataframe = SupplyTime.__concat_frames([df1, df2])
         dataframe = dataframe.groupby(['period_from', 'period'],
-                                      as_index=False).agg(
+                                      as_index=False, observed=True).agg(
             volume=('volume', np.sum),
             gas_KWh=('gas_KWh', np.sum),
         )
@@ -512,73 +1298,83 @@ class SupplyTime(DataTables):
         return dataframe
 
     @staticmethod
-    def __gen_frame_from_sql(start_date: pd.Timestamp, end_date: pd.Timestamp,
-                             table_name: str, divider=1,
-                             date_type='День') -> pd.DataFrame:
+    def __compact_frame(dataframe: pd.DataFrame) -> pd.DataFrame:
         """
-        Common method for all functions which generates frame. This method
-        selects a sql request to database (there are no empty values in db's
-        data, because it was fixed in to_agg func in
-        download_data/download_no_vpn.py) and returns pd.DataFrame in certain
-        format (name of columns)
-        !!! when all volume values are equal to 0 then returns empty frame
-            :param start_date: pd.Timestamp (period_from filter)
-            :param end_date: pd.Timestamp (period_from filter)
-            :param table_name: str, name of table (tables from
-                agg_data_pages_csv, e.g. 'AT_HU_CTWIT_ex_21Z000000000003C')
-            :param divider: int, 1 or 1000,characteristic of measurement:
-                if 1 then in millions of m3, if 1000 then in billions of m3
-            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
-                different types of grouping data by period_from
+        Converts columns of frame to compact dtypes: repeated text columns
+        (_CATEGORY_COLUMNS) to category and period_from to datetime64.
+        volume and gas_KWh stay float64: they are summed by groupbys and
+        float32 errors change rounded (2 decimals) totals
+            :param dataframe: pd.DataFrame from __gen_frame_from_sql
+            :return: pd.DataFrame
+        """
+        for column in SupplyTime._CATEGORY_COLUMNS:
+            if column in dataframe.columns:
+                dataframe[column] = dataframe[column].astype('category')
+        if 'period_from' in dataframe.columns:
+            dataframe['period_from'] = pd.to_datetime(
+                dataframe['period_from'])
+        return dataframe
 
-            :return: pd.DataFrame with data or empty frame when all volume
-                values are equal to 0.
-                Important:
-                    column 'period_from' - pd.Timestamp.
-                    column 'period' - str, special for date_type
-                        (e.g. '22 января 2022)
+    @staticmethod
+    def __concat_frames(frames: list) -> pd.DataFrame:
+        """
+        Concatenates frames into one. Categorical columns get the union of
+        categories before concatenation, otherwise pd.concat turns them
+        back into object columns
+            :param frames: list of pd.DataFrame
+            :return: pd.DataFrame, empty frame if all frames are empty
+        """
+        frames = [item for item in frames if not item.empty]
+        if not frames:
+            return pd.DataFrame({})
+        for column in frames[0].columns:
+            columns = [item[column] for item in frames
+                       if column in item.columns]
+            if all(isinstance(item.dtype, pd.CategoricalDtype)
+                   for item in columns):
+                categories = sorted(set().union(
+                    *[item.cat.categories for item in columns]))
+                for item in frames:
+                    if column in item.columns:
+                        item[column] = item[column].cat.set_categories(
+                            categories)
+        return pd.concat(frames)
+
+    @staticmethod
+    def __get_table_defaults(table_name: str) -> tuple:
+        """
+        Returns default values of country_from, country_to and point_type
+        for table, which are used in sql when columns are Null
+            :param table_name: str, name of table (e.g.
+                'AT_HU_CTWIT_ex_21Z000000000003C')
+            :return: tuple of str (country_from, country_to, point_type)
         """
         country_from = CONST.CODE_COUNTRY_DICT[table_name[:2]]
         country_to = CONST.CODE_COUNTRY_DICT[table_name[3:5]]
-        point_id = table_name[15:]
-        point_name = CONST.ID_NAME_DICT[point_id]
-
-        # Delete inappropriate symbols (if no - can be errors in sql database
-        # request)
-        point_name = point_name.replace('/', ' ')
-        point_name = point_name.replace("'", '')
         point_type_short = table_name[6:11]
         point_type_name = CONST.SHORT_POINT_DICT[point_type_short]
 
         # Take one of many type names, divided by '/'
         if '/' in point_type_name:
             point_type_name = point_type_name.split('/')[0]
+        return country_from, country_to, point_type_name
 
-        start_prefix = f'''
-            with main as (
-                select 
-                    coalesce(m.country_from, '{country_from}') as country_from,
-                    coalesce(m.country_to, '{country_to}') as country_to,
-                    '{point_name}' as point,
-                    m.period_from, 
-                    case when m.gcv_value is not Null and m.gcv_value > 0 
-                        then round(m.gas_KWh/{divider}/m.gcv_value/1000000, 2)
-                        else round(m.gas_KWh/{divider}/11.4/1000000, 2) end
-                    as volume,
-                    m.gcv_value,
-                    m.gas_KWh, 
-                    coalesce(m.point_type, '{point_type_name}') as point_type
-
-                from table_{table_name.replace('-', '_')} as m
-                where strftime('%Y-%m-%d', m.period_from) >= '{start_date.date()}'
-                    and strftime('%Y-%m-%d', m.period_from) <= '{end_date.date()}'
-
-                order by strftime('%Y-%m-%d', m.period_from)
-            )
-        '''
+    @staticmethod
+    def __gen_period_sql(date_type: str, group_columns=()) -> str:
+        """
+        Returns select part of sql request, which gets rows of 'main' table
+        (columns country_from, country_to, point, period_from, volume,
+        gas_KWh) grouped by periods of date_type
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
+                different types of grouping data by period_from
+            :param group_columns: tuple of str, columns of 'main' which are
+                grouped besides period (when 'main' has several countries)
+            :return: str, sql
+        """
+        group_prefix = ''.join(f't.{item}, ' for item in group_columns)
 
         if date_type == 'День':
-            sql = start_prefix + f'''\n
+            sql = f'''\n
                 select 
                     t.country_from, t.country_to, t.point,
                     t.period_from,  
@@ -608,7 +1404,7 @@ class SupplyTime(DataTables):
             # (ex. week starts at 29 of Dec)
             # case when is used to throw out cases
             # when some days are Null in one week
-            sql = start_prefix + f'''\n 
+            sql = f'''\n 
                 select 
 
                     t.country_from, t.country_to, t.point,
@@ -619,7 +1415,7 @@ class SupplyTime(DataTables):
                     sum(coalesce(t.gas_KWh, 0)) as gas_KWh
 
                 from main as t
-                group by strftime('%Y-%W', t.period_from)
+                group by {group_prefix}strftime('%Y-%W', t.period_from)
 
                 having count(coalesce(t.gas_KWh, 0)) = 7
                 '''
@@ -628,7 +1424,7 @@ class SupplyTime(DataTables):
             # Having is used to throw out not full months
             # case when is used to throw out cases when some
             # days are Null in one month
-            sql = start_prefix + f'''\n 
+            sql = f'''\n 
                 select 
                     t.country_from, t.country_to, t.point,
                     t.period_from,  
@@ -648,12 +1444,12 @@ class SupplyTime(DataTables):
                     sum(coalesce(t.gas_KWh, 0)) as gas_KWh
 
                 from main as t
-                group by strftime('%Y-%m', t.period_from)
+                group by {group_prefix}strftime('%Y-%m', t.period_from)
                 having count(coalesce(t.gas_KWh, 0)) = CAST(STRFTIME('%d', DATE(t.period_from,'start of month','+1 month','-1 day')) AS INTEGER)
             '''
 
         elif date_type == 'Год':
-            sql = start_prefix + f'''\n 
+            sql = f'''\n 
                 select 
                     t.country_from, t.country_to, t.point,
                     t.period_from,  
@@ -662,11 +1458,253 @@ class SupplyTime(DataTables):
                     sum(coalesce(t.gas_KWh, 0)) as gas_KWh
 
                 from main as t
-                group by strftime('%Y', t.period_from)
+                group by {group_prefix}strftime('%Y', t.period_from)
                 order by t.period_from
             '''
 
-        sql_frame = pd.read_sql(sql, con)
+        return sql
+
+    @staticmethod
+    def __get_volume_sql(divider=1) -> str:
+        """
+        Returns sql expression of volume for row of table 'm' in millions
+        (divider=1) or billions (divider=1000) of m3
+            :param divider: int, 1 or 1000
+            :return: str, sql
+        """
+        return f'''case when m.gcv_value is not Null and m.gcv_value > 0 
+                        then round(m.gas_KWh/{divider}/m.gcv_value/1000000, 2)
+                        else round(m.gas_KWh/{divider}/11.4/1000000, 2) end'''
+
+    @staticmethod
+    def __rank_tables(tables_list: list, start_date: pd.Timestamp,
+                      end_date: pd.Timestamp) -> dict:
+        """
+        Counts total volume over the period for every table in one request
+        (or several requests of _UNION_BATCH tables)
+            :param tables_list: list of str, list of names of tables
+            :param start_date: pd.Timestamp (period_from filter)
+            :param end_date: pd.Timestamp (period_from filter)
+            :return: dict, name of table -> total volume (millions of m3)
+        """
+        totals = {}
+        volume_sql = SupplyTime.__get_volume_sql()
+        for i in range(0, len(tables_list), SupplyTime._UNION_BATCH):
+            sql = ' union all '.join(f'''
+                select '{table_name}' as table_name,
+                    coalesce(sum({volume_sql}), 0) as volume
+                from table_{table_name.replace('-', '_')} as m
+                where strftime('%Y-%m-%d', m.period_from) >= '{start_date.date()}'
+                    and strftime('%Y-%m-%d', m.period_from) <= '{end_date.date()}'
+            ''' for table_name in tables_list[i:i + SupplyTime._UNION_BATCH])
+            with con_lock:
+                totals.update(con.execute(sql).fetchall())
+        return totals
+
+    def __split_top_tables(self, tables_list: list, start_date: pd.Timestamp,
+                           end_date: pd.Timestamp, group_column=None,
+                           with_direction=False) -> tuple:
+        """
+        Splits tables into tables of top_n lines (points or countries from
+        group_column) with the biggest total volume and other tables. Tables
+        with the same line on the graph are ranked together.
+        If top_n is not set or there are not more than top_n lines, all
+        tables are top tables
+            :param tables_list: list of str, list of names of tables
+            :param start_date: pd.Timestamp (period_from filter)
+            :param end_date: pd.Timestamp (period_from filter)
+            :param group_column: str, one of 'country_from', 'country_to' or
+                None to rank points
+            :param with_direction: bool, if True line of point is its name
+                with country_from and country_to (as for selected points),
+                else its name
+            :return: tuple (list of top tables, list of other tables)
+        """
+        if group_column is None:
+            # the same point name as in __gen_frame_from_sql
+            keys = {table_name: CONST.ID_NAME_DICT[table_name[15:]].replace(
+                '/', ' ').replace("'", '') for table_name in tables_list}
+            if with_direction:
+                keys = {table_name: self.__get_table_defaults(table_name)[:2] +
+                        (point_name,)
+                        for table_name, point_name in keys.items()}
+        else:
+            code_slice = slice(0, 2) if group_column == 'country_from' \
+                else slice(3, 5)
+            keys = {table_name: CONST.CODE_COUNTRY_DICT[table_name[code_slice]]
+                    for table_name in tables_list}
+        if self._top_n is None or len(set(keys.values())) <= self._top_n:
+            return tables_list, []
+
+        key_totals = {}
+        for table_name, volume in self.__rank_tables(
+                tables_list, start_date, end_date).items():
+            key = keys[table_name]
+            key_totals[key] = key_totals.get(key, 0) + abs(volume)
+        top_keys = set(sorted(key_totals, key=key_totals.get,
+                              reverse=True)[:self._top_n])
+        top_tables = [item for item in tables_list if keys[item] in top_keys]
+        other_tables = [item for item in tables_list
+                        if keys[item] not in top_keys]
+        return top_tables, other_tables
+
+    @staticmethod
+    def __gen_other_frame_from_sql(start_date: pd.Timestamp,
+                                   end_date: pd.Timestamp, tables_list: list,
+                                   divider=1, date_type='День',
+                                   compact=False) -> pd.DataFrame:
+        """
+        Generates one frame in the same format as __gen_frame_from_sql with
+        daily sum of all tables in tables_list (summed inside one sql
+        request), country_from, country_to and point are equal to
+        OTHER_LABEL. Tables are united by batches of _UNION_BATCH (sqlite
+        limits number of terms of 'union all'), daily sums of batches are
+        summed again, so full weeks/months are checked once for the whole
+        sum, not for every table or batch.
+        !!! when all volume values are equal to 0 then returns empty frame
+            :param start_date: pd.Timestamp (period_from filter)
+            :param end_date: pd.Timestamp (period_from filter)
+            :param tables_list: list of str, list of names of tables
+            :param divider: int, 1 or 1000,characteristic of measurement:
+                if 1 then in millions of m3, if 1000 then in billions of m3
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
+                different types of grouping data by period_from
+            :param compact: bool, if True converts frame by __compact_frame
+            :return: pd.DataFrame
+        """
+        label = SupplyTime.OTHER_LABEL
+        volume_sql = SupplyTime.__get_volume_sql(divider)
+        batches_sql = []
+        for i in range(0, len(tables_list), SupplyTime._UNION_BATCH):
+            union_sql = ' union all '.join(f'''
+                select m.period_from, {volume_sql} as volume, m.gas_KWh
+                from table_{table_name.replace('-', '_')} as m
+                where strftime('%Y-%m-%d', m.period_from) >= '{start_date.date()}'
+                    and strftime('%Y-%m-%d', m.period_from) <= '{end_date.date()}'
+            ''' for table_name in tables_list[i:i + SupplyTime._UNION_BATCH])
+            batches_sql.append(f'''
+                select * from (
+                    select
+                        min(u.period_from) as period_from,
+                        sum(u.volume) as volume,
+                        sum(u.gas_KWh) as gas_KWh
+                    from ({union_sql}) as u
+                    group by strftime('%Y-%m-%d', u.period_from)
+                )
+            ''')
+        sql = f'''
+            with main as (
+                select
+                    '{label}' as country_from,
+                    '{label}' as country_to,
+                    '{label}' as point,
+                    min(b.period_from) as period_from,
+                    sum(b.volume) as volume,
+                    sum(b.gas_KWh) as gas_KWh
+                from ({' union all '.join(batches_sql)}) as b
+                group by strftime('%Y-%m-%d', b.period_from)
+                order by strftime('%Y-%m-%d', b.period_from)
+            )
+        ''' + SupplyTime.__gen_period_sql(date_type)
+        with con_lock:
+            sql_frame = pd.read_sql(sql, con)
+
+        if not (sql_frame['volume'] != 0).any():
+            return pd.DataFrame({})
+        if compact:
+            sql_frame = SupplyTime.__compact_frame(sql_frame)
+        return sql_frame
+
+    def __fold_top_n(self, dataframe: pd.DataFrame,
+                     group_column: str) -> pd.DataFrame:
+        """
+        Renames values of group_column out of top_n values with the biggest
+        total volume to OTHER_LABEL (they are summed by following groupby).
+        Used for frames, which are already grouped in sql (materialized EU
+        series)
+            :param dataframe: pd.DataFrame
+            :param group_column: str, one of 'country_from', 'country_to'
+            :return: pd.DataFrame
+        """
+        if self._top_n is None or dataframe.empty:
+            return dataframe
+        totals = dataframe['volume'].abs().groupby(
+            dataframe[group_column], observed=True).sum()
+        if len(totals) <= self._top_n:
+            return dataframe
+        top_keys = totals.nlargest(self._top_n).index
+        dataframe = dataframe.copy()
+        dataframe[group_column] = dataframe[group_column].astype(str).where(
+            dataframe[group_column].isin(top_keys), self.OTHER_LABEL)
+        if self._compact:
+            dataframe[group_column] = dataframe[group_column].astype(
+                'category')
+        return dataframe
+
+    @staticmethod
+    def __gen_frame_from_sql(start_date: pd.Timestamp, end_date: pd.Timestamp,
+                             table_name: str, divider=1,
+                             date_type='День',
+                             compact=False) -> pd.DataFrame:
+        """
+        Common method for all functions which generates frame. This method
+        selects a sql request to database (there are no empty values in db's
+        data, because it was fixed in to_agg func in
+        download_data/download_no_vpn.py) and returns pd.DataFrame in certain
+        format (name of columns)
+        !!! when all volume values are equal to 0 then returns empty frame
+            :param start_date: pd.Timestamp (period_from filter)
+            :param end_date: pd.Timestamp (period_from filter)
+            :param table_name: str, name of table (tables from
+                agg_data_pages_csv, e.g. 'AT_HU_CTWIT_ex_21Z000000000003C')
+            :param divider: int, 1 or 1000,characteristic of measurement:
+                if 1 then in millions of m3, if 1000 then in billions of m3
+            :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
+                different types of grouping data by period_from
+            :param compact: bool, if True converts frame by __compact_frame
+
+            :return: pd.DataFrame with data or empty frame when all volume
+                values are equal to 0.
+                Important:
+                    column 'period_from' - pd.Timestamp.
+                    column 'period' - str, special for date_type
+                        (e.g. '22 января 2022)
+        """
+        country_from, country_to, point_type_name = \
+            SupplyTime.__get_table_defaults(table_name)
+        point_id = table_name[15:]
+        point_name = CONST.ID_NAME_DICT[point_id]
+
+        # Delete inappropriate symbols (if no - can be errors in sql database
+        # request)
+        point_name = point_name.replace('/', ' ')
+        point_name = point_name.replace("'", '')
+
+        start_prefix = f'''
+            with main as (
+                select 
+                    coalesce(m.country_from, '{country_from}') as country_from,
+                    coalesce(m.country_to, '{country_to}') as country_to,
+                    '{point_name}' as point,
+                    m.period_from, 
+                    {SupplyTime.__get_volume_sql(divider)}
+                    as volume,
+                    m.gcv_value,
+                    m.gas_KWh, 
+                    coalesce(m.point_type, '{point_type_name}') as point_type
+
+                from table_{table_name.replace('-', '_')} as m
+                where strftime('%Y-%m-%d', m.period_from) >= '{start_date.date()}'
+                    and strftime('%Y-%m-%d', m.period_from) <= '{end_date.date()}'
+
+                order by strftime('%Y-%m-%d', m.period_from)
+            )
+        '''
+
+        sql = start_prefix + SupplyTime.__gen_period_sql(date_type)
+
+        with con_lock:
+            sql_frame = pd.read_sql(sql, con)
 
         # Check if frame is empty
         un_values = list(sql_frame['volume'].unique())
@@ -677,11 +1715,14 @@ class SupplyTime(DataTables):
                     sql_frame = pd.DataFrame({})
             else:
                 sql_frame = pd.DataFrame({})
+        if compact and not sql_frame.empty:
+            sql_frame = SupplyTime.__compact_frame(sql_frame)
         return sql_frame
 
     def __gen_df_by_point(self, tables_list: list, start_date: pd.Timestamp,
                           end_date: pd.Timestamp, divider=1,
-                          date_type='День') -> pd.DataFrame:
+                          date_type='День',
+                          with_direction=False) -> pd.DataFrame:
         """
         Method generates pd.DataFrame using __gen_frame_from_sql for every
         table in tables_list and concatenates these frames into one
@@ -693,6 +1734,8 @@ class SupplyTime(DataTables):
                 if 1 then in millions of m3, if 1000 then in billions of m3
             :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
                 different types of grouping data by period_from
+            :param with_direction: bool, True if point names are shown with
+                countries (selected points), used for top_n
             :return: pd.DataFrame
         """
 
@@ -700,11 +1743,19 @@ class SupplyTime(DataTables):
         if not tables_list:
             self.__set_global_data(dataframe)
         else:
-            for table in tables_list:
-                cur_frame = self.__gen_frame_from_sql(
+            tables_list, other_tables = self.__split_top_tables(
+                tables_list=tables_list, start_date=start_date,
+                end_date=end_date, with_direction=with_direction)
+            frames = [self.__gen_frame_from_sql(
+                start_date=start_date, end_date=end_date, table_name=table,
+                divider=divider, date_type=date_type, compact=self._compact)
+                for table in tables_list]
+            if other_tables:
+                frames.append(self.__gen_other_frame_from_sql(
                     start_date=start_date, end_date=end_date,
-                    table_name=table, divider=divider, date_type=date_type)
-                dataframe = pd.concat([dataframe, cur_frame])
+                    tables_list=other_tables, divider=divider,
+                    date_type=date_type, compact=self._compact))
+            dataframe = self.__concat_frames(frames)
 
             self.__set_global_data(dataframe)
         return dataframe
@@ -712,10 +1763,12 @@ class SupplyTime(DataTables):
     def __gen_df_by_country(self, tables_list: list, start_date: pd.Timestamp,
                             end_date: pd.Timestamp, divider=1,
                             date_type='День',
-                            exp_or_imp_groupby='country_from') -> pd.DataFrame:
+                            exp_or_imp_groupby='country_from',
+                            eu_series=None) -> pd.DataFrame:
         """
         Method generates pd.DataFrame using __gen_frame_from_sql for every
-        table in tables_list, concatenates these frames into one and then
+        table in tables_list (or materialized EU series if eu_series is set
+        and available), concatenates these frames into one and then
         group them by exp_or_imp_groupby, period_from and period columns
             :param tables_list: list of str, list of names of tables (e.g.
                 ['AT_HU_CTWIT_ex_21Z000000000003C'])
@@ -726,17 +1779,37 @@ class SupplyTime(DataTables):
             :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
                 different types of grouping data by period_from
             :param exp_or_imp_groupby: str, one of 'period_from', 'period_to'
+            :param eu_series: tuple (series, condition) from
+                __select_eu_series or None
             :return: pd.DataFrame
         """
         dataframe = pd.DataFrame({})
         if not tables_list:
             self.__set_global_data(dataframe)
         else:
-            for table in tables_list:
-                cur_frame = self.__gen_frame_from_sql(
+            if eu_series is not None and \
+                    date_type in self._EU_AGGREGATES_DATE_TYPES and \
+                    self.__eu_aggregates_ready(eu_series[0]):
+                dataframe = self.__gen_frame_from_eu_aggregates(
+                    eu_series=eu_series, start_date=start_date,
+                    end_date=end_date, divider=divider, date_type=date_type,
+                    group_column=exp_or_imp_groupby)
+                dataframe = self.__fold_top_n(dataframe, exp_or_imp_groupby)
+            else:
+                tables_list, other_tables = self.__split_top_tables(
+                    tables_list=tables_list, start_date=start_date,
+                    end_date=end_date, group_column=exp_or_imp_groupby)
+                frames = [self.__gen_frame_from_sql(
                     start_date=start_date, end_date=end_date,
-                    table_name=table, divider=divider, date_type=date_type)
-                dataframe = pd.concat([dataframe, cur_frame])
+                    table_name=table, divider=divider, date_type=date_type,
+                    compact=self._compact)
+                    for table in tables_list]
+                if other_tables:
+                    frames.append(self.__gen_other_frame_from_sql(
+                        start_date=start_date, end_date=end_date,
+                        tables_list=other_tables, divider=divider,
+                        date_type=date_type, compact=self._compact))
+                dataframe = self.__concat_frames(frames)
 
             # dataframe can be empty even if table_list is not empty,
             # because when all volume values are equal to 0 gen_frame_from_sql
@@ -746,7 +1819,8 @@ class SupplyTime(DataTables):
                 # and country_to
                 dataframe = dataframe.groupby([exp_or_imp_groupby,
                                                'period_from', 'period'],
-                                              as_index=False).agg(
+                                              as_index=False,
+                                              observed=True).agg(
                     volume=('volume', np.sum),
                     gas_KWh=('gas_KWh', np.sum),
                 )
@@ -762,10 +1836,11 @@ class SupplyTime(DataTables):
 
     def __gen_df_by_sum(self, tables_list: list, start_date: pd.Timestamp,
                         end_date: pd.Timestamp, divider=1,
-                        date_type='День') -> pd.DataFrame:
+                        date_type='День', eu_series=None) -> pd.DataFrame:
         """
         Method generates pd.DataFrame using __gen_frame_from_sql for every
-        table in tables_list, concatenates these frames into one and then
+        table in tables_list (or materialized EU series if eu_series is set
+        and available), concatenates these frames into one and then
         group them by period_from and period columns
             :param tables_list: list of str, list of names of tables (e.g.
                 ['AT_HU_CTWIT_ex_21Z000000000003C'])
@@ -775,6 +1850,8 @@ class SupplyTime(DataTables):
                 if 1 then in millions of m3, if 1000 then in billions of m3
             :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
                 different types of grouping data by period_from
+            :param eu_series: tuple (series, condition) from
+                __select_eu_series or None
             :return: pd.DataFrame
         """
 
@@ -782,26 +1859,39 @@ class SupplyTime(DataTables):
         if not tables_list:
             self.__set_global_data(dataframe)
         else:
-            for table in tables_list:
-                cur_frame = self.__gen_frame_from_sql(
+            if eu_series is not None and \
+                    date_type in self._EU_AGGREGATES_DATE_TYPES and \
+                    self.__eu_aggregates_ready(eu_series[0]):
+                dataframe = self.__gen_frame_from_eu_aggregates(
+                    eu_series=eu_series, start_date=start_date,
+                    end_date=end_date, divider=divider, date_type=date_type)
+            else:
+                frames = [self.__gen_frame_from_sql(
                     start_date=start_date, end_date=end_date,
-                    table_name=table, divider=divider, date_type=date_type)
-                dataframe = pd.concat([dataframe, cur_frame])
+                    table_name=table, divider=divider, date_type=date_type,
+                    compact=self._compact)
+                    for table in tables_list]
+                dataframe = self.__concat_frames(frames)
 
-            dataframe = dataframe.groupby(
-                ['period_from', 'period'], as_index=False).agg(
-                volume=('volume', np.sum),
-                gas_KWh=('gas_KWh', np.sum),
-            )
-            dataframe = dataframe.sort_values(by=['period_from'])
+            # dataframe can be empty even if table_list is not empty,
+            # because when all volume values are equal to 0 gen_frame_from_sql
+            # returns empty frame (or there are no full periods)
+            if not dataframe.empty:
+                dataframe = dataframe.groupby(
+                    ['period_from', 'period'], as_index=False,
+                    observed=True).agg(
+                    volume=('volume', np.sum),
+                    gas_KWh=('gas_KWh', np.sum),
+                )
+                dataframe = dataframe.sort_values(by=['period_from'])
             self.__set_global_data(dataframe)
 
         return dataframe
 
     def __gen_df(self, tables_list: list, groupby='point',
                  start_date=pd.Timestamp, end_date=pd.Timestamp, divider=1,
-                 date_type='День', exp_or_imp_groupby='country_from') -> \
-            pd.DataFrame:
+                 date_type='День', exp_or_imp_groupby='country_from',
+                 eu_series=None) -> pd.DataFrame:
         """
         Method generates pd.DataFrame depending on groupby. For particular
         groupby it calls certain method (gen_df_by_sum, ..by_country,
@@ -821,6 +1911,8 @@ class SupplyTime(DataTables):
             :param date_type: str, one of 'День', 'Неделя', 'Месяц', 'Год' -
                 different types of grouping data by period_from
             :param exp_or_imp_groupby: str, one of 'period_from', 'period_to'
+            :param eu_series: tuple (series, condition) from
+                __select_eu_series or None, used by 'country' and 'sum'
             :return: pd.DataFrame
         """
         data = pd.DataFrame({})
@@ -836,12 +1928,172 @@ class SupplyTime(DataTables):
                                             end_date=end_date,
                                             divider=divider,
                                             date_type=date_type,
-                                            exp_or_imp_groupby=exp_or_imp_groupby)
+                                            exp_or_imp_groupby=exp_or_imp_groupby,
+                                            eu_series=eu_series)
         elif groupby == 'sum':
             data = self.__gen_df_by_sum(tables_list=tables_list,
                                         start_date=start_date,
                                         end_date=end_date,
                                         divider=divider,
-                                        date_type=date_type)
+                                        date_type=date_type,
+                                        eu_series=eu_series)
 
         return data
+
+
+def export_supply_time(output, file_format='csv', **params) -> int:
+    """
+    Streams SupplyTime data to csv or parquet chunk by chunk (one parquet
+    row group per chunk), so memory usage doesn't depend on the length of
+    the period (see SupplyTime.iter_frames). Header (schema) is written
+    even if there are no rows
+        :param output: str path of file or opened stream (text stream for
+            csv, binary stream for parquet)
+        :param file_format: str, one of 'csv', 'parquet'
+        :param params: init params of SupplyTime (see SupplyTime.__init__)
+            except top_n and max_points, and chunk_months (see
+            SupplyTime.iter_frames)
+        :return: int, number of written rows
+    """
+    if file_format not in ('csv', 'parquet'):
+        raise ValueError(f'Unknown file_format: {file_format}')
+    chunks = SupplyTime._iter_chunks(**params)
+    rows = 0
+
+    if file_format == 'csv':
+        is_path = isinstance(output, (str, os.PathLike))
+        stream = open(output, 'w', newline='', encoding='utf-8') \
+            if is_path else output
+        try:
+            supply_time = None
+            for supply_time in chunks:
+                frame = supply_time.get_data()
+                if not frame.empty:
+                    frame.to_csv(stream, header=rows == 0, index=False)
+                    rows += len(frame)
+            if rows == 0:
+                supply_time.get_empty_frame().to_csv(stream, index=False)
+        finally:
+            if is_path:
+                stream.close()
+
+    elif file_format == 'parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError('pyarrow is required for parquet export') \
+                from error
+        writer = None
+        try:
+            supply_time = None
+            for supply_time in chunks:
+                frame = supply_time.get_data()
+                if frame.empty:
+                    continue
+                if writer is None:
+                    table = pa.Table.from_pandas(frame, preserve_index=False)
+                    writer = pq.ParquetWriter(output, table.schema)
+                else:
+                    table = pa.Table.from_pandas(frame, schema=writer.schema,
+                                                 preserve_index=False)
+                writer.write_table(table)
+                rows += len(frame)
+            if writer is None:
+                # No rows: write file with schema only, text columns of empty
+                # frame have null type in arrow, so they are made strings
+                table = pa.Table.from_pandas(supply_time.get_empty_frame(),
+                                             preserve_index=False)
+                schema = pa.schema([
+                    pa.field(item.name, pa.string())
+                    if pa.types.is_null(item.type) else item
+                    for item in table.schema])
+                pq.write_table(table.cast(schema), output)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    return rows
+
+
+# Coalesces concurrent SupplyTime computations with equal parameters, can be
+# replaced by single_flight.FileSingleFlight to coalesce across processes
+SUPPLY_TIME_FLIGHT = SingleFlight()
+
+
+def _supply_time_key(params: dict) -> tuple:
+    """
+    Normalizes init params of SupplyTime into hashable key: dates are
+    reduced to days (sql filters use only dates), lists become tuples
+        :param params: dict, init params of SupplyTime
+        :return: tuple of (name, value) pairs sorted by name
+    """
+    key = []
+    for name, value in sorted(params.items()):
+        if name in ('start_date', 'end_date') and value is not None:
+            value = pd.Timestamp(value).date().isoformat()
+        elif isinstance(value, list):
+            value = tuple(value)
+        key.append((name, value))
+    return tuple(key)
+
+
+def get_supply_time(timeout: float = None, flight=None,
+                    **params) -> SupplyTime:
+    """
+    Returns SupplyTime for params. Concurrent calls with equal normalized
+    params wait for one computation (or get the same exception), every
+    caller receives its own copy of the result and sets its global data
+    (unless set_global_data=False is passed), as if it created SupplyTime
+        :param timeout: float, seconds to wait for computation started by
+            another caller, if None - wait forever
+        :param flight: SingleFlight or FileSingleFlight, if None -
+            SUPPLY_TIME_FLIGHT
+        :param params: init params of SupplyTime (see SupplyTime.__init__)
+        :return: SupplyTime
+    """
+    if flight is None:
+        flight = SUPPLY_TIME_FLIGHT
+    set_global_data = params.pop('set_global_data', True)
+    supply_time = flight.do(
+        _supply_time_key(params),
+        lambda: SupplyTime(set_global_data=False, **params), timeout=timeout)
+    if set_global_data:
+        supply_time.publish_global_data()
+    return supply_time.copy()
+
+
+# Longest window of rolling statistics on the supply tabs by date_type,
+# history of this length is fetched for every window, so changing window
+# hits the cache
+ROLLING_MAX_WINDOW = {'День': 30, 'Неделя': 8, 'Месяц': 6, 'Год': 2}
+# Keeps SupplyTime with history for rolling statistics for ttl seconds, not
+# more than max_entries of them per process
+ROLLING_FLIGHT = SingleFlight(ttl=300, max_entries=16)
+
+
+def get_rolling_data(window: int, stats=('mean', 'min', 'max', 'cum'),
+                     timeout: float = None, **params) -> pd.DataFrame:
+    """
+    Returns copy of SupplyTime data with rolling statistics (see
+    SupplyTime.get_rolling_data) and sets global data of SupplyTime (unless
+    set_global_data=False is passed). SupplyTime with history of
+    max(window, ROLLING_MAX_WINDOW[date_type]) periods and its rolling
+    statistics are cached in ROLLING_FLIGHT, so requests with other windows
+    don't query database again
+        :param window: int, number of periods of date_type in window
+        :param stats: tuple of str, any of 'mean', 'min', 'max', 'cum'
+        :param timeout: float, seconds to wait for computation started by
+            another caller, if None - wait forever
+        :param params: init params of SupplyTime (see SupplyTime.__init__)
+        :return: pd.DataFrame
+    """
+    set_global_data = params.pop('set_global_data', True)
+    params['rolling_lookback'] = max(
+        window, ROLLING_MAX_WINDOW.get(params.get('date_type'), window))
+    supply_time = ROLLING_FLIGHT.do(
+        _supply_time_key(params),
+        lambda: SupplyTime(set_global_data=False, **params), timeout=timeout)
+    if set_global_data:
+        supply_time.publish_global_data()
+    return supply_time.get_rolling_data(window, stats).copy()
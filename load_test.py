@@ -0,0 +1,357 @@
+"""
+Load testing harness for app_data.py. Replays a mix of SupplyTime parameter
+sets from N threads in each of M processes against synthetic or copied
+database and reports throughput, latency percentiles, con_lock wait time
+(with --con-lock), errors and cross-request leakage through
+global_vars.CURRENT_GRAPH_DATA.
+
+Usage:
+    python load_test.py --db /tmp/load_data --synthetic --threads 8 \
+        --processes 2 --requests 400
+    python load_test.py --db /tmp/load_data --synthetic --con-lock
+    python load_test.py --db /tmp/load_data --copy-from ../../databases/data
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from CONSTANTS import CONST
+import global_vars as global_vars
+import app_data
+
+
+class TimedLock:
+    """
+    Replacement of app_data.con_lock, which serializes requests to the
+    shared connection and accumulates time spent on waiting for the lock by
+    every thread
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self._lock.acquire()
+        self._local.wait = getattr(self._local, 'wait', 0.0) + \
+            time.perf_counter() - started
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+    def pop_wait(self) -> float:
+        """
+        Returns accumulated wait time of current thread and resets it
+            :return: float, seconds
+        """
+        wait = getattr(self._local, 'wait', 0.0)
+        self._local.wait = 0.0
+        return wait
+
+
+def create_synthetic_db(path: str, start_date: str, end_date: str,
+                        seed=0) -> None:
+    """
+    Creates database with table for every name in CONST.FILES_NAME_LIST
+    filled with random daily data in the same format as download_data
+    writes (country and point type columns are Null, so defaults from table
+    names are used)
+        :param path: str, path of new database
+        :param start_date: str, first day of data
+        :param end_date: str, last day of data
+        :param seed: int, seed of random generator
+    """
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_date, end_date, freq='D').strftime(
+        '%Y-%m-%d %H:%M:%S')
+    connection = sqlite3.connect(path)
+    try:
+        for table_name in CONST.FILES_NAME_LIST:
+            sql_name = f"table_{table_name.replace('-', '_')}"
+            connection.execute(f'drop table if exists {sql_name}')
+            connection.execute(f'''
+                create table {sql_name} (
+                    country_from text, country_to text, period_from text,
+                    gcv_value real, gas_KWh real, point_type text
+                )
+            ''')
+            gcv_values = rng.uniform(10.5, 12.0, len(days))
+            gas_kwh = rng.uniform(0, 5e8, len(days)) * rng.uniform(0, 2)
+            connection.executemany(
+                f'insert into {sql_name} (period_from, gcv_value, gas_KWh) '
+                f'values (?, ?, ?)',
+                zip(days, gcv_values.tolist(), gas_kwh.tolist()))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def copy_db(source_path: str, path: str) -> None:
+    """
+    Copies database with sqlite backup api (safe while source is used)
+        :param source_path: str, path of source database
+        :param path: str, path of copy
+    """
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def gen_param_sets(count: int, start_date: str, end_date: str,
+                   seed=0) -> list:
+    """
+    Generates mix of realistic SupplyTime init params: exporter, importer,
+    pairs of countries, 'ЕС', points, groups of exporters to EU and net
+    flows with random periods inside [start_date, end_date]
+        :param count: int, number of parameter sets
+        :param start_date: str, first available day
+        :param end_date: str, last available day
+        :param seed: int, seed of random generator
+        :return: list of dicts
+    """
+    rnd = random.Random(seed)
+    countries = [item for item in CONST.COUNTRY_CODE_DICT if item != 'ЕС']
+    points = list(CONST.NAME_ID_DICT)
+    groups = list(CONST.GROUP_EXPORT)
+    days = pd.date_range(start_date, end_date, freq='D')
+
+    param_sets = []
+    for _ in range(count):
+        first, last = sorted(rnd.sample(range(len(days)), 2))
+        params = dict(start_date=days[first].date().isoformat(),
+                      end_date=days[last].date().isoformat(),
+                      measure=rnd.choice(['millions', 'billions']),
+                      date_type=rnd.choice(['День', 'Неделя', 'Месяц',
+                                            'Год']),
+                      groupby=rnd.choice(['point', 'country', 'sum']),
+                      flow_type='gross_flow', exporter_to_eu=None,
+                      exporter=None, importer=None, selected_points=None)
+        case = rnd.choice(['exporter', 'importer', 'pair', 'eu', 'points',
+                           'exporter_to_eu', 'net_flow'])
+        if case == 'exporter':
+            params['exporter'] = rnd.choice(countries)
+        elif case == 'importer':
+            params['importer'] = rnd.choice(countries)
+        elif case == 'pair':
+            params['exporter'], params['importer'] = rnd.sample(countries, 2)
+        elif case == 'eu':
+            params[rnd.choice(['exporter', 'importer'])] = 'ЕС'
+            params['groupby'] = 'sum'
+        elif case == 'points':
+            params['selected_points'] = rnd.sample(points,
+                                                   min(3, len(points)))
+        elif case == 'exporter_to_eu' and groups:
+            params['exporter_to_eu'] = rnd.choice(groups)
+        else:
+            params['flow_type'] = 'net_flow'
+            params['exporter'] = rnd.choice(countries)
+            params['groupby'] = 'sum'
+        param_sets.append(params)
+    return param_sets
+
+
+def _frame_signature(dataframe: pd.DataFrame) -> tuple:
+    """
+    Returns (number of rows, rounded sum of volume) of frame
+    """
+    if dataframe is None or dataframe.empty:
+        return 0, 0.0
+    return len(dataframe), round(float(dataframe['volume'].sum()), 3)
+
+
+def _matches(params: dict, data: pd.DataFrame, global_data: pd.DataFrame,
+             own_global_data: pd.DataFrame) -> bool:
+    """
+    Checks that data lies inside the period of params and global data,
+    read right after SupplyTime creation, is the global data set by the same
+    request (not by concurrent one). Requests which didn't set global data
+    (e.g. with empty result) are checked only by period
+    """
+    if own_global_data is not None and \
+            _frame_signature(global_data) != _frame_signature(own_global_data):
+        return False
+    if data.empty:
+        return True
+    period_from = pd.to_datetime(data['period_from'])
+    return period_from.min() >= pd.Timestamp(params['start_date']) and \
+        period_from.max() < pd.Timestamp(params['end_date']) + \
+        pd.Timedelta(days=1)
+
+
+def _run_request(params: dict, lock: TimedLock = None) -> dict:
+    """
+    Creates SupplyTime for params and measures it
+        :param lock: TimedLock, installed as app_data.con_lock, if None -
+            lock wait is not measured (None)
+        :return: dict with latency, lock_wait, error and leaked keys
+    """
+    if lock is not None:
+        lock.pop_wait()
+    started = time.perf_counter()
+    error = None
+    leaked = False
+    try:
+        supply = app_data.SupplyTime(**params)
+        leaked = not _matches(params, supply.get_data(),
+                              global_vars.CURRENT_GRAPH_DATA,
+                              supply.get_global_data())
+    except Exception as request_error:
+        error = repr(request_error)
+    return dict(latency=time.perf_counter() - started,
+                lock_wait=None if lock is None else lock.pop_wait(),
+                error=error, leaked=leaked)
+
+
+def _run_process(db_path: str, param_sets: list, threads: int,
+                 con_lock=False) -> list:
+    """
+    Replays param_sets from threads sharing one connection, like threads of
+    one dash worker
+        :param con_lock: bool, serialize requests to the connection by
+            TimedLock
+        :return: list of dicts from _run_request
+    """
+    app_data.con = sqlite3.connect(db_path, check_same_thread=False,
+                                   timeout=10)
+    lock = None
+    if con_lock:
+        lock = TimedLock()
+        app_data.con_lock = lock
+    queue = list(param_sets)
+    queue_lock = threading.Lock()
+    results = []
+
+    def worker():
+        while True:
+            with queue_lock:
+                if not queue:
+                    return
+                params = queue.pop()
+            result = _run_request(params, lock)
+            with queue_lock:
+                results.append(result)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for item in workers:
+        item.start()
+    for item in workers:
+        item.join()
+    return results
+
+
+def run(db_path: str, param_sets: list, requests: int, threads=4,
+        processes=1, seed=0, con_lock=False) -> dict:
+    """
+    Replays requests randomly chosen from param_sets and returns report
+        :param db_path: str, path of database
+        :param param_sets: list of dicts, init params of SupplyTime
+        :param requests: int, total number of requests
+        :param threads: int, number of threads in every process
+        :param processes: int, number of processes
+        :param seed: int, seed of random generator
+        :param con_lock: bool, serialize requests to the connection inside
+            every process and measure wait time
+        :return: dict, see report
+    """
+    rnd = random.Random(seed)
+    replay = [rnd.choice(param_sets) for _ in range(requests)]
+    chunks = [replay[i::processes] for i in range(processes)]
+
+    started = time.perf_counter()
+    if processes == 1:
+        results = _run_process(db_path, chunks[0], threads, con_lock)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = sum(pool.starmap(
+                _run_process,
+                [(db_path, item, threads, con_lock) for item in chunks]), [])
+    return report(results, time.perf_counter() - started)
+
+
+def report(results: list, elapsed: float) -> dict:
+    """
+    Aggregates results of requests
+        :param results: list of dicts from _run_request
+        :param elapsed: float, wall time in seconds
+        :return: dict with throughput, latency percentiles, lock wait (None
+            if it was not measured, i.e. without TimedLock), errors and leaks
+    """
+    latencies = np.array([item['latency'] for item in results])
+    waits = np.array([item['lock_wait'] for item in results
+                      if item['lock_wait'] is not None])
+    errors = [item['error'] for item in results if item['error']]
+    if not results:
+        latencies = np.zeros(1)
+    lock_wait_total = lock_wait_p95 = None
+    if len(waits):
+        lock_wait_total = float(waits.sum())
+        lock_wait_p95 = float(np.percentile(waits, 95))
+    return dict(
+        requests=len(results),
+        throughput=len(results) / elapsed if elapsed else 0.0,
+        p50=float(np.percentile(latencies, 50)),
+        p95=float(np.percentile(latencies, 95)),
+        p99=float(np.percentile(latencies, 99)),
+        lock_wait_total=lock_wait_total,
+        lock_wait_p95=lock_wait_p95,
+        errors=len(errors),
+        error_examples=sorted(set(errors))[:5],
+        leaked=sum(item['leaked'] for item in results),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', required=True, help='path of test database')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='create synthetic database at --db')
+    parser.add_argument('--copy-from', help='copy database to --db')
+    parser.add_argument('--start-date', default='2020-01-01')
+    parser.add_argument('--end-date', default='2022-12-31')
+    parser.add_argument('--params', help='json file with list of '
+                                         'SupplyTime params')
+    parser.add_argument('--param-sets', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--con-lock', action='store_true',
+                        help='serialize requests to the shared connection '
+                             'and report lock wait time (without it lock '
+                             'wait is null - not measured)')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        create_synthetic_db(args.db, args.start_date, args.end_date,
+                            seed=args.seed)
+    elif args.copy_from:
+        copy_db(args.copy_from, args.db)
+
+    if args.params:
+        with open(args.params, encoding='utf-8') as params_file:
+            param_sets = json.load(params_file)
+    else:
+        param_sets = gen_param_sets(args.param_sets, args.start_date,
+                                    args.end_date, seed=args.seed)
+
+    result = run(args.db, param_sets, args.requests, threads=args.threads,
+                 processes=args.processes, seed=args.seed,
+                 con_lock=args.con_lock)
+    print(json.dumps(result, ensure_ascii=False, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # fcntl is available only on unix, FileSingleFlight can't be used without
+    # it, but SingleFlight can
+    fcntl = None
+
+
+class SingleFlight:
+    """
+    Class coalesces concurrent calls with equal keys inside one process:
+    the first caller (leader) computes the result, other callers wait for it
+    and receive the same object or the same exception. Result is shared
+    between callers, so it should be treated as read-only. With ttl > 0
+    successful results are also returned to later callers for ttl seconds,
+    with max_entries only so many of them are kept (least recently used are
+    dropped first).
+    """
+
+    class _Call:
+        """
+        State of one in-progress computation
+        """
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+            self.expires_at = None
+
+    def __init__(self, ttl: float = 0, max_entries: int = None):
+        """
+        :param ttl: float, seconds to keep successful results, if 0 - results
+            are not kept after computation
+        :param max_entries: int, max number of kept results, if None - not
+            limited
+        """
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # Insertion order is order of use of kept results
+        self._calls = {}
+
+    def do(self, key, func, timeout: float = None):
+        """
+        Returns result of func(), computed once for all concurrent callers
+        with equal key
+            :param key: hashable, normalized parameters of computation
+            :param func: callable without arguments
+            :param timeout: float, seconds to wait for computation of
+                another caller, if None - wait forever
+            :return: result of func
+        """
+        with self._lock:
+            if self._ttl > 0:
+                self.__drop_expired()
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._Call()
+                self._calls[key] = call
+            elif call.expires_at is not None:
+                self._calls[key] = self._calls.pop(key)
+
+        if is_leader:
+            try:
+                call.result = func()
+            except BaseException as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    if self._ttl > 0 and call.error is None:
+                        call.expires_at = time.monotonic() + self._ttl
+                        if self._max_entries is not None:
+                            self.__drop_least_used()
+                    else:
+                        del self._calls[key]
+                call.event.set()
+        elif not call.event.wait(timeout):
+            raise TimeoutError(f'Computation for {key} is not finished '
+                               f'in {timeout} seconds')
+
+        if call.error is not None:
+            if is_leader or isinstance(call.error, Exception):
+                raise call.error
+            # KeyboardInterrupt, SystemExit etc. are not raised in threads
+            # of waiting callers
+            raise RuntimeError(f'Computation for {key} was interrupted') \
+                from call.error
+        return call.result
+
+    def __drop_expired(self) -> None:
+        """
+        Deletes kept results with expired ttl (called under self._lock)
+        """
+        now = time.monotonic()
+        expired = [key for key, call in self._calls.items()
+                   if call.expires_at is not None and call.expires_at <= now]
+        for key in expired:
+            del self._calls[key]
+
+    def __drop_least_used(self) -> None:
+        """
+        Deletes kept results above max_entries, least recently used first
+        (called under self._lock), computations in progress are not deleted
+        """
+        kept = [key for key, call in self._calls.items()
+                if call.expires_at is not None]
+        for key in kept[:max(len(kept) - self._max_entries, 0)]:
+            del self._calls[key]
+
+
+class FileSingleFlight:
+    """
+    Class coalesces concurrent calls with equal keys across processes of
+    one host. Calls are serialized by file lock (fcntl.flock) in lock_dir,
+    the leader pickles result (or exception) into lock_dir and callers,
+    which were waiting for the lock, read it instead of computing again.
+    Result files older than result_ttl and their lock files are deleted.
+    Inside one process calls are also coalesced by SingleFlight.
+    """
+
+    def __init__(self, lock_dir: str, poll_interval: float = 0.05,
+                 result_ttl: float = 60):
+        """
+        :param lock_dir: str, directory for lock and result files
+        :param poll_interval: float, seconds between attempts to get lock
+        :param result_ttl: float, seconds after which result file is deleted
+            (waiting callers read it right after it is written)
+        """
+        if fcntl is None:
+            raise RuntimeError('FileSingleFlight requires fcntl (unix only)')
+        os.makedirs(lock_dir, exist_ok=True)
+        self._lock_dir = lock_dir
+        self._poll_interval = poll_interval
+        self._result_ttl = result_ttl
+        self._cleaned_at = 0.0
+        self._local = SingleFlight()
+
+    def do(self, key, func, timeout: float = None):
+        """
+        Returns result of func(), computed once for all concurrent callers
+        with equal key in all processes which use the same lock_dir
+            :param key: hashable with stable repr, normalized parameters of
+                computation
+            :param func: callable without arguments, result must be picklable
+            :param timeout: float, seconds to wait for lock, if None - wait
+                forever
+            :return: result of func
+        """
+        if time.monotonic() - self._cleaned_at >= self._result_ttl:
+            self._cleaned_at = time.monotonic()
+            self.__clean()
+        return self._local.do(key, lambda: self.__do_locked(key, func,
+                                                            timeout),
+                              timeout=timeout)
+
+    def __do_locked(self, key, func, timeout: float = None):
+        """
+        Gets file lock for key and returns fresh result of another process or
+        computes it
+        """
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        lock_path = os.path.join(self._lock_dir, name + '.lock')
+        result_path = os.path.join(self._lock_dir, name + '.pickle')
+        requested_at = time.time()
+
+        with self.__open_locked(lock_path, timeout) as lock_file:
+            try:
+                # Result is fresh if it was written after this call had been
+                # started, i.e. computation was in progress while we waited
+                try:
+                    is_fresh = \
+                        os.path.getmtime(result_path) >= requested_at
+                except FileNotFoundError:
+                    is_fresh = False
+                if is_fresh:
+                    with open(result_path, 'rb') as result_file:
+                        result, error = pickle.load(result_file)
+                else:
+                    result, error = None, None
+                    try:
+                        result = func()
+                    except Exception as func_error:
+                        error = func_error
+                    self.__dump(result_path, result, error)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        if error is not None:
+            raise error
+        return result
+
+    def __open_locked(self, lock_path: str, timeout: float = None):
+        """
+        Opens lock_path and waits for its exclusive lock. If the file was
+        deleted by __clean while we were waiting, opens the new one
+            :return: opened and locked file
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            lock_file = open(lock_path, 'a+b')
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if deadline is not None and \
+                                time.monotonic() >= deadline:
+                            raise TimeoutError(
+                                f'Lock {lock_path} is not released in '
+                                f'{timeout} seconds')
+                        time.sleep(self._poll_interval)
+                if self.__is_same_file(lock_file, lock_path):
+                    return lock_file
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    @staticmethod
+    def __is_same_file(opened_file, path: str) -> bool:
+        """
+        Checks that opened_file is still the file at path
+        """
+        try:
+            return os.path.samestat(os.fstat(opened_file.fileno()),
+                                    os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def __clean(self) -> None:
+        """
+        Deletes result files older than result_ttl, their lock files (only
+        when they are not locked) and forgotten temporary files
+        """
+        expired_at = time.time() - self._result_ttl
+        # Result files go first, so their lock files are deleted in the same
+        # pass
+        for file_name in sorted(os.listdir(self._lock_dir),
+                                key=lambda name: name.endswith('.lock')):
+            path = os.path.join(self._lock_dir, file_name)
+            try:
+                if file_name.endswith('.lock'):
+                    result_path = path[:-len('.lock')] + '.pickle'
+                    if os.path.exists(result_path) or \
+                            os.path.getmtime(path) >= expired_at:
+                        continue
+                    with open(path, 'a+b') as lock_file:
+                        try:
+                            fcntl.flock(lock_file,
+                                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        if self.__is_same_file(lock_file, path):
+                            os.remove(path)
+                elif file_name.endswith(('.pickle', '.tmp')) and \
+                        os.path.getmtime(path) < expired_at:
+                    os.remove(path)
+            except FileNotFoundError:
+                # deleted by another process
+                continue
+
+    @staticmethod
+    def __dump(result_path: str, result, error) -> None:
+        """
+        Atomically writes (result, error) into result_path
+        """
+        tmp_path = f'{result_path}.{os.getpid()}.tmp'
+        try:
+            payload = pickle.dumps((result, error))
+        except Exception:
+            # Exceptions with unpicklable state are passed as RuntimeError
+            payload = pickle.dumps((result, RuntimeError(repr(error))))
+        with open(tmp_path, 'wb') as result_file:
+            result_file.write(payload)
+        os.replace(tmp_path, result_path)